@@ -0,0 +1,779 @@
+"""
+Builds GeoJSON maps of the routes sampled by explore.py. route.py is the
+command line entry point.
+"""
+
+import logging
+import math
+import sys
+
+cache = {}
+
+# Number of clustering cells along one side of a map tile, i.e. points closer
+# than roughly 256 / CELLS_PER_TILE pixels at a given zoom are merged.
+CELLS_PER_TILE = 4
+
+# Zoom levels accepted for clustering, as used by common web map tiles.
+MIN_ZOOM, MAX_ZOOM = 0, 22
+
+
+def coordinate(ip_info):
+    return [float(ip_info['Lng']), float(ip_info['Lat'])]
+
+
+def check_zoom(zoom):
+    if not MIN_ZOOM <= zoom <= MAX_ZOOM:
+        raise ValueError('zoom must be between {} and {}'.format(MIN_ZOOM, MAX_ZOOM))
+
+    return zoom
+
+
+def parse_zooms(value):
+    """Parse a zoom level "N" or an inclusive range "A-B"."""
+    low, _, high = value.partition('-')
+    low = int(low)
+    high = int(high) if high else low
+    if low > high:
+        raise ValueError('empty zoom range: ' + value)
+
+    return [check_zoom(zoom) for zoom in range(low, high + 1)]
+
+
+def cell(coordinates, zoom):
+    size = 360.0 / (1 << zoom) / CELLS_PER_TILE
+    return (int(math.floor(coordinates[0] / size)), int(math.floor(coordinates[1] / size)))
+
+
+def parent_cell(key, shift):
+    # Cells halve in size with every zoom level, so the cell containing a
+    # point at a coarser level follows from its cell at a finer one.
+    return (key[0] >> shift, key[1] >> shift)
+
+
+class Point(object):
+    def __init__(self, ip_info, **properties):
+        for network in ip_info['Networks']:
+            properties['AS{}'.format(network['ASN'])] = network['ASName']
+
+        self.type = 'Feature'
+        self.geometry = {
+            'type': 'Point',
+            'coordinates': coordinate(ip_info),
+        }
+        self.properties = properties
+
+    def update(self, point):
+        self.properties.update(point.properties)
+
+    def to_object(self):
+        return vars(self)
+    
+    def __hash__(self):
+        return hash('point:' + ','.join([str(c) for c in self.geometry['coordinates']]))
+
+
+class Line(object):
+    def __init__(self, *points, **properties):
+        coordinates = []
+        for point in points:
+            if coordinates:
+                last_point = coordinates[-1]
+                if hash(last_point) == hash(point):
+                    last_point.update(point)
+                    continue
+            
+            coordinates.append(point)
+
+        if len(coordinates) == 1:
+            raise Exception('Cannot draw a line')
+
+        self.type = 'Feature'
+        self.geometry = {
+            'type': 'LineString',
+            'coordinates': [point.geometry['coordinates'] for point in coordinates],
+        }
+        self.properties = properties
+
+    def update(self, line):
+        self.properties.update(line.properties)
+
+    def to_object(self):
+        return vars(self)
+
+    def __hash__(self):
+        s = []
+        for item in self.geometry['coordinates']:
+            s.extend([str(c) for c in item])
+
+        return hash('line:' + ','.join(s))
+
+
+ 
+class GeoJSON(object):
+    def __init__(self):
+        self.type = "FeatureCollection"
+        self.features = {}
+        self.levels = {}
+
+    def add_route(self, source, source_info, target, target_info, hops):
+        ttl = 0
+        last_phases, final_phases = [], []
+        if source_info:
+            point = self.add_point(source, source_info)
+            if point:
+                last_phases.append((point, 0, ttl))
+        if target_info:
+            point = self.add_point(target, target_info)
+            if point:
+                final_phases.append((point, sys.maxsize, ttl))
+
+        for probes in hops:
+            ttl += 1
+
+            phases = []
+            for probe in probes:
+                if not probe:
+                    continue
+
+                hop, rtt, hop_info = probe
+                point = self.add_point(hop, hop_info)
+                if not point:
+                    continue
+
+                phases.append((point, rtt, ttl))
+
+            if phases:
+                for a in last_phases:
+                    for b in phases:
+                        self.add_line(a[0], b[0])
+
+                last_phases = phases
+
+        if final_phases:
+            for a in last_phases:
+                for b in final_phases:
+                    self.add_line(a[0], b[0])
+
+    def add_point(self, ip, ip_info, **properties):
+        try:
+            point = Point(ip_info, **properties)
+            k = hash(point)
+            v = self.features.get(k)
+            if v:
+                v.update(point)
+            else:
+                self.features[k] = point
+            self.levels.clear()
+
+            return point
+        except Exception as err:
+            logging.error('add point for {} failed: {}'.format(ip, err), exc_info=True)
+
+    def add_line(self, *points):
+        try:
+            line = Line(*points)
+            k = hash(line)
+            v = self.features.get(k)
+            if v:
+                v.update(line)
+            else:
+                self.features[k] = line
+            self.levels.clear()
+
+            return line
+        except Exception as err:
+            logging.error('add line failed: {}'.format(err), exc_info=True)
+
+    def cluster(self, zooms):
+        """
+        Merge points falling into the same grid cell at each of the given
+        zooms into a single weighted point, and lines running between the
+        same cells (in either direction) into a single weighted bundle.
+        Cells are computed once at the finest zoom and coarsened from there.
+        """
+        finest = max(zooms)
+
+        points, lines = [], []
+        for v in self.features.values():
+            if isinstance(v, Point):
+                coordinates = v.geometry['coordinates']
+                points.append((cell(coordinates, finest), coordinates, v.properties))
+            else:
+                keys = [cell(coordinates, finest) for coordinates in v.geometry['coordinates']]
+                lines.append((keys, v.properties))
+
+        levels = {}
+        for zoom in zooms:
+            shift = finest - zoom
+            clusters = {}
+
+            for key, coordinates, properties in points:
+                key = parent_cell(key, shift)
+                c = clusters.get(key)
+                if c is None:
+                    c = clusters[key] = {'lng': 0.0, 'lat': 0.0, 'count': 0, 'properties': {}}
+                c['lng'] += coordinates[0]
+                c['lat'] += coordinates[1]
+                c['count'] += 1
+                c['properties'].update(properties)
+
+            bundles = {}
+            for line_keys, line_properties in lines:
+                # Every line vertex is one of the points added above, so its
+                # cell always has a cluster.
+                keys = []
+                for key in line_keys:
+                    key = parent_cell(key, shift)
+                    if not keys or keys[-1] != key:
+                        keys.append(key)
+
+                if len(keys) < 2:
+                    continue
+
+                keys = tuple(keys)
+                if keys[::-1] < keys:
+                    keys = keys[::-1]
+
+                bundle = bundles.get(keys)
+                if bundle is None:
+                    bundle = bundles[keys] = {'weight': 0, 'properties': {}}
+                bundle['weight'] += 1
+                bundle['properties'].update(line_properties)
+
+            centers = {}
+            features = []
+            for key, c in clusters.items():
+                centers[key] = [c['lng'] / c['count'], c['lat'] / c['count']]
+                properties = dict(c['properties'], count=c['count'])
+                features.append({
+                    'type': 'Feature',
+                    'geometry': {'type': 'Point', 'coordinates': centers[key]},
+                    'properties': properties,
+                })
+
+            for keys, bundle in bundles.items():
+                properties = dict(bundle['properties'], weight=bundle['weight'])
+                features.append({
+                    'type': 'Feature',
+                    'geometry': {'type': 'LineString', 'coordinates': [centers[k] for k in keys]},
+                    'properties': properties,
+                })
+
+            levels[zoom] = features
+
+        return levels
+
+    def to_object(self, zoom=None):
+        if zoom is None:
+            features = []
+            for v in self.features.values():
+                features.append(v.to_object())
+        else:
+            features = self.levels.get(check_zoom(zoom))
+            if features is None:
+                features = self.levels[zoom] = self.cluster([zoom])[zoom]
+
+        return {
+            'type': self.type,
+            'features': features,
+        }
+
+    def to_pyramid(self, zooms):
+        """Clustered feature collections for several zooms, keyed by zoom."""
+        missing = [check_zoom(zoom) for zoom in zooms if zoom not in self.levels]
+        if missing:
+            self.levels.update(self.cluster(missing))
+
+        return dict((zoom, self.to_object(zoom)) for zoom in zooms)
+
+def import_urlopen():
+    if sys.version_info[0] >= 3:
+        from urllib.request import urlopen
+    else:
+        from urllib2 import urlopen
+
+    return urlopen
+
+
+class IPParser(object):
+    """
+    Looks up the info of an IP through the HTTP API. urllib is only
+    imported on the first lookup, which routes loaded from the pickle never
+    need.
+    """
+    def __init__(self, api):
+        self.api = api
+        self.urlopen = None
+
+    def __call__(self, ip):
+        if self.urlopen is None:
+            import json
+
+            self.loads = json.loads
+            self.urlopen = import_urlopen()
+
+        try:
+            r = self.urlopen(self.api + '/' + ip)
+            if r.getcode() == 200:
+                return self.loads(r.read().decode('utf8'))
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+
+def parse_ip(api, ip):
+    return IPParser(api)(ip)
+
+
+def parse_traceroute(ip_parser, *items):
+    import parser
+    from functools import reduce
+
+    for data in items:
+        trp = parser.TracerouteParser()
+        trp.parse_data(data)
+
+        hops = []
+        for hop in trp.hops:
+            probes = []
+            for probe in hop.probes:
+                value = None
+                if probe.ipaddr:
+                    ipinfo = cache.get(probe.ipaddr)
+                    if not ipinfo:
+                        ipinfo = ip_parser(probe.ipaddr)
+                        cache[probe.ipaddr] = ipinfo
+                    value = (probe.ipaddr, probe.rtt, ipinfo)
+
+                probes.append(value)
+
+            hops.append(probes)
+
+        for i in range(-1, -len(hops)-1, -1):
+            n = reduce(lambda x, y: int(bool(x)) + int(bool(y)), hops[i])
+            if n > 0:
+                if i != -1:
+                    hops = hops[:i+1]
+                break
+
+        yield (trp.dest_ip, hops)
+
+
+def fetch_routes(targets, ip_parser):
+    """
+    Yield the routes sampled by the nodes that serve each target IP. Every
+    node is downloaded only once per call.
+    """
+    import json
+
+    if sys.version_info[0] >= 3:
+        from urllib.parse import urlparse
+    else:
+        from urlparse import urlparse
+
+    urlopen = import_urlopen()
+    seen = set()
+
+    for ip in targets:
+        try:
+            r = urlopen('http://g3.letv.com/r?uip={uip}&format={format}'.format(uip=ip, format=1), timeout=5)
+            data = json.loads(r.read().decode('utf8'))
+
+            for node in data.get('nodelist', []):
+                try:
+                    urlparser = urlparse(node['location'])
+                    source = urlparser[1]
+                    url = '{scheme}://{netloc}{path}'.format(scheme=urlparser[0], netloc=source, path='/explore-route.json')
+                    if url in seen:
+                        continue
+
+                    logging.info("Downloading routes from {}".format(url))
+                    r = urlopen(url, timeout=5)
+                    text = r.read().decode('utf8')
+                    status_code = r.getcode()
+                    logging.info("Status code {}, content size {}".format(status_code, len(text)))
+
+                    if status_code == 200:
+                        seen.add(url)
+                        data = json.loads(text)
+                        source_info = cache.get(source)
+                        if not source_info:
+                            source_info = ip_parser(source)
+                            cache[source] = source_info
+
+                        for (target, hops) in parse_traceroute(ip_parser, *data):
+                            target_info = cache.get(target)
+                            if not target_info:
+                                target_info = ip_parser(target)
+                                cache[target] = target_info
+
+                            yield (source, source_info, target, target_info, hops)
+                except Exception as e:
+                    logging.error(e, exc_info=True)
+
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+
+def get_routes(ip, ip_parser):
+    return fetch_routes([ip], ip_parser)
+
+
+def match(patterns, ip_info):
+    def get_values(d):
+        v = []
+        t = type(d)
+
+        if t == dict:
+            for item in d.values():
+                v.extend(get_values(item))
+        elif t == list:
+            for item in d:
+                v.extend(get_values(item))
+        else:
+            v.append(str(d))
+
+        return v
+
+    if ip_info:
+        values = get_values(ip_info)
+        matched = 0
+
+        for pattern in patterns:
+            for item in values:
+                if pattern.search(item):
+                    matched += 1
+                    break
+        return matched == len(patterns)
+
+    return False
+
+
+def compile_patterns(patterns, kind):
+    import re
+
+    compiled = []
+    for pattern in patterns or []:
+        logging.info('Using {} pattern: {}'.format(kind, pattern))
+        compiled.append(re.compile(pattern, re.IGNORECASE))
+
+    return compiled
+
+
+def read_routes(filename):
+    import pickle
+
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        logging.error(e, exc_info=True)
+        return []
+
+
+def load_routes(filename, update, targets, ip_parser, history=None):
+    """
+    Load routes from the pickle, or fetch them when updating or when it is
+    empty. Without targets, the ones of explore.py are sampled; that module
+    is only imported when a fetch actually happens.
+    """
+    import os
+    import pickle
+
+    routes = []
+    if not update:
+        routes = read_routes(filename)
+
+    if not routes:
+        logging.info("Fetching routes.")
+        if not targets:
+            import explore
+            targets = explore.targets
+
+        routes.extend(fetch_routes(targets, ip_parser))
+
+        if not routes:
+            logging.warning('No routes fetched, keeping {}'.format(filename))
+            return read_routes(filename) if update else routes
+
+        logging.info('Dumping routes into {}'.format(filename))
+        tmp_filename = filename + '.tmp'
+        tmp = open(tmp_filename, 'wb')
+        pickle.dump(routes, tmp, protocol=2)
+        tmp.close()
+        os.rename(tmp_filename, filename)
+
+        if history:
+            import history as route_history
+            route_history.History(history).add(routes)
+
+    return routes
+
+
+def render(routes, source_network, target_network):
+    geo_json = GeoJSON()
+    for route in routes:
+        if not match(source_network, route[1]) or not match(target_network, route[3]):
+            continue
+
+        geo_json.add_route(*route)
+
+    return geo_json
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        import threading
+        from collections import OrderedDict
+
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+
+            return value
+
+    def setdefault(self, key, value):
+        with self.lock:
+            value = self.items.pop(key, value)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+            return value
+
+
+class RouteStore(object):
+    """
+    Keeps the parsed routes resident and caches rendered GeoJSON by filter key
+    and zoom. Routes and caches are swapped together as one tuple so readers
+    never see a half-refreshed state.
+    """
+    def __init__(self, filename, targets, ip_parser, filters=32, responses=256):
+        self.filename = filename
+        self.targets = targets
+        self.ip_parser = ip_parser
+        self.filters = filters
+        self.responses = responses
+        self.mtime = None
+        self.loaded = False
+        self.state = self.new_state([])
+
+    def new_state(self, routes):
+        return (routes, LRUCache(self.filters), LRUCache(self.responses))
+
+    def refresh(self, update=False):
+        import os
+
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except OSError:
+            mtime = None
+
+        # Without update, routes are only fetched by the first refresh; after
+        # that a missing file counts as no change rather than a reason to
+        # crawl again on every tick.
+        if not update and self.loaded and (mtime is None or mtime == self.mtime):
+            return False
+
+        self.loaded = True
+        routes = load_routes(self.filename, update, self.targets, self.ip_parser)
+        try:
+            self.mtime = os.path.getmtime(self.filename)
+        except OSError:
+            self.mtime = None
+
+        if not routes and self.state[0]:
+            logging.warning('Refresh returned no routes, keeping the current ones')
+            return False
+
+        self.state = self.new_state(routes)
+        logging.info('Loaded {} routes'.format(len(routes)))
+        return True
+
+    def query(self, source_patterns, target_patterns, zoom=None):
+        import json
+
+        # Misses are rendered without holding any lock, so a slow render only
+        # delays requests for the same key; concurrent duplicates are dropped
+        # by setdefault.
+        routes, geo_jsons, responses = self.state
+        key = (tuple(sorted(set(source_patterns))), tuple(sorted(set(target_patterns))))
+        body = responses.get((key, zoom))
+        if body is None:
+            geo_json = geo_jsons.get(key)
+            if geo_json is None:
+                geo_json = geo_jsons.setdefault(key, render(routes,
+                                                            compile_patterns(key[0], 'source'),
+                                                            compile_patterns(key[1], 'target')))
+            body = responses.setdefault((key, zoom), json.dumps(geo_json.to_object(zoom)).encode('utf8'))
+
+        return body
+
+
+def serve(store, host, port, interval, update):
+    import re
+    import threading
+
+    if sys.version_info[0] >= 3:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+        from urllib.parse import parse_qs, urlparse
+    else:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urlparse import parse_qs, urlparse
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path not in ('/', '/routes'):
+                self.send_error(404)
+                return
+
+            params = parse_qs(url.query)
+            unknown = set(params) - set(['source-network', 'target-network', 'zoom'])
+            if unknown:
+                self.send_error(400, 'Unknown parameters: ' + ', '.join(sorted(unknown)))
+                return
+
+            try:
+                zoom = params.get('zoom')
+                zoom = check_zoom(int(zoom[0])) if zoom else None
+                body = store.query(params.get('source-network', []),
+                                   params.get('target-network', []),
+                                   zoom)
+            except (ValueError, re.error) as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                self.send_error(500, 'Internal server error')
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    def refresher():
+        stop = threading.Event()
+        while not stop.wait(interval):
+            try:
+                store.refresh(update)
+            except Exception as e:
+                logging.error(e, exc_info=True)
+
+    store.refresh(update)
+
+    if interval > 0:
+        t = threading.Thread(target=refresher)
+        t.daemon = True
+        t.start()
+
+    server = Server((host, port), Handler)
+    logging.info('Serving routes on http://{}:{}/routes'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    import json
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [serve] [target ...]')
+    parser.add_option('-q', '--ip-api', 
+                      dest='ip_api', 
+                      default='http://127.0.0.1:8080',
+                      help='HTTP API to retrieve IP info.')
+    parser.add_option('-f', '--file',
+                      default='route.pickle',
+                      help='Use the pickled routes')
+    parser.add_option('-u', '--update',
+                      action="store_true",
+                      default=False,
+                      help='Update routes; in serve mode, re-fetch at startup and on every refresh')
+    parser.add_option('--history',
+                      help='Record fetched routes as a snapshot in this directory, not available in serve mode')
+    parser.add_option('--source-network',
+                      dest='source_network',
+                      action='append',
+                      help='Regex of source network pattern')
+    parser.add_option('--target-network',
+                      dest='target_network',
+                      action='append',
+                      help='Regex of target network pattern')
+    parser.add_option('-z', '--zoom',
+                      help='Cluster points and bundle lines for the given map zoom level, '
+                           'or for every level of a range like 0-10, keyed by zoom')
+    parser.add_option('--host',
+                      default='127.0.0.1',
+                      help='Address to listen on in serve mode')
+    parser.add_option('--port',
+                      type='int',
+                      default=8081,
+                      help='Port to listen on in serve mode')
+    parser.add_option('--refresh',
+                      type='float',
+                      default=60,
+                      help='Seconds between route refreshes in serve mode, 0 to disable')
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(levelname)1.1s %(asctime)s %(module)s:%(lineno)d] %(message)s')
+
+    zooms = None
+    if options.zoom is not None:
+        try:
+            zooms = parse_zooms(options.zoom)
+        except ValueError as e:
+            parser.error('invalid zoom {}: {}'.format(options.zoom, e))
+
+    serving = args[:1] == ['serve']
+    if serving:
+        args = args[1:]
+        for name, value in (('--zoom', options.zoom),
+                            ('--source-network', options.source_network),
+                            ('--target-network', options.target_network)):
+            if value:
+                parser.error('{} is a query parameter in serve mode'.format(name))
+        if options.history:
+            parser.error('--history is not supported in serve mode, record snapshots with route.py --update')
+
+    parse_ip = IPParser(options.ip_api)
+
+    if serving:
+        store = RouteStore(options.file, args, parse_ip)
+        serve(store, options.host, options.port, options.refresh, options.update)
+        return
+
+    source_network = compile_patterns(options.source_network, 'source')
+    target_network = compile_patterns(options.target_network, 'target')
+
+    routes = load_routes(options.file, options.update, args, parse_ip, options.history)
+
+    geo_json = render(routes, source_network, target_network)
+
+    if zooms is None:
+        print(json.dumps(geo_json.to_object()))
+    elif '-' in options.zoom:
+        print(json.dumps(geo_json.to_pyramid(zooms)))
+    else:
+        print(json.dumps(geo_json.to_object(zooms[0])))
+
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+import re
+import sys
+import time
+
 targets = [
     # Unicom, China-North
     '202.106.196.115', # BJ
@@ -141,49 +145,283 @@ targets = [
 ]
 
 
-def traceroute(host, out, sema):
+def traceroute(host):
     import subprocess
 
-    try:
-        sema.acquire()
-        pipe = subprocess.Popen(["traceroute", host],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        data, err = pipe.communicate()
-        if pipe.returncode != 0:
-            raise Exception(err.decode('utf-8'))
+    pipe = subprocess.Popen(["traceroute", host],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    data, err = pipe.communicate()
+    if pipe.returncode != 0:
+        raise Exception(err.decode('utf-8'))
 
-        out.append(data)
-    except Exception as e:
-        import sys
-        sys.stderr.write(str(e))
-    finally:
-        sema.release()
+    return data.decode('utf-8')
 
 
-def main():
-    import json
-    import threading
+HEADER_RE = re.compile(r'traceroute to \S+ \((\d+\.\d+\.\d+\.\d+)\)')
+ADDRESS_RE = re.compile(r'\((\d+\.\d+\.\d+\.\d+)\)')
 
-    params = []
-    sema = threading.BoundedSemaphore(value=10) 
 
-    for host in targets:
-        if not host:
+def parse_path(data):
+    """
+    Destination and hop addresses of a traceroute, one sorted list per hop.
+    Kept to a regex so that probe nodes only need this script.
+    """
+    dest_ip, hops = None, []
+    for line in data.splitlines():
+        line = line.strip()
+        if not line:
             continue
+        if line.lower().startswith('traceroute'):
+            mob = HEADER_RE.match(line)
+            if mob:
+                dest_ip = mob.group(1)
+        else:
+            hops.append(sorted(set(ADDRESS_RE.findall(line))))
+
+    return dest_ip, hops
+
+
+def path_hash(hops):
+    """Hash of the hop addresses in a traceroute, ignoring RTTs."""
+    import hashlib
+
+    return hashlib.sha1('|'.join(','.join(hop) for hop in hops).encode('utf-8')).hexdigest()
+
+
+class Scheduler(object):
+    """
+    Decides which targets to probe based on their history. A target whose
+    path came back unchanged is probed half as often each time, up to
+    max_interval, and drops back to interval once its path changes. A
+    target that traceroute fails on or never reaches backs off the same way.
+    Probes are started at no more than rate per second and run on a pool of
+    workers.
+    """
+    def __init__(self, hosts, state=None, interval=300, max_interval=86400, rate=0, workers=10):
+        import threading
+
+        self.hosts = hosts
+        self.state = state if state is not None else {}
+        self.interval = interval
+        self.max_interval = max_interval
+        self.rate = rate
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def backoff(self, n):
+        return min(self.interval * (2 ** min(n, 32)), self.max_interval)
+
+    def due(self, now):
+        """Targets due for a probe, most overdue first."""
+        hosts = []
+        for host in self.hosts:
+            entry = self.state.get(host)
+            next_probe = entry['next_probe'] if entry else 0
+            if next_probe <= now:
+                hosts.append((next_probe, host))
+
+        return [host for _, host in sorted(hosts)]
+
+    def next_due(self):
+        times = [self.state[host]['next_probe'] if host in self.state else 0 for host in self.hosts]
+        return min(times) if times else None
+
+    def update(self, host, data, now):
+        entry = self.state.setdefault(host, {
+            'hash': None,
+            'data': None,
+            'stable': 0,
+            'failures': 0,
+            'last_seen': None,
+        })
+        entry['last_probe'] = now
+        # Only the output of the latest probe is ever published, so a target
+        # that stopped answering never shows an old path as current.
+        entry['data'] = data
+
+        hops = None
+        if data is not None:
+            dest_ip, hops = parse_path(data)
+            # traceroute exits successfully on unreachable targets, it just
+            # never gets an answer from the destination.
+            if not hops or dest_ip not in hops[-1]:
+                hops = None
+
+        if hops is None:
+            entry['failures'] += 1
+            entry['next_probe'] = now + self.backoff(entry['failures'])
+            return
+
+        h = path_hash(hops)
+        if h == entry['hash']:
+            entry['stable'] += 1
+        else:
+            entry['stable'] = 0
+
+        entry['hash'] = h
+        entry['failures'] = 0
+        entry['last_seen'] = now
+        entry['next_probe'] = now + self.backoff(entry['stable'])
+
+    def pace(self):
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + 1.0 / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+    def probe(self, host):
+        self.pace()
+        try:
+            data = traceroute(host)
+        except Exception as e:
+            sys.stderr.write('{}: {}\n'.format(host, e))
+            data = None
+
+        with self.lock:
+            self.update(host, data, time.time())
+
+    def run_once(self):
+        """Probe every due target and return how many were probed."""
+        import threading
+
+        try:
+            from queue import Queue, Empty
+        except ImportError:
+            from Queue import Queue, Empty
+
+        queue = Queue()
+        hosts = self.due(time.time())
+        for host in hosts:
+            queue.put(host)
+
+        def worker():
+            while True:
+                try:
+                    host = queue.get_nowait()
+                except Empty:
+                    return
+                self.probe(host)
+
+        threads = []
+        for _ in range(min(self.workers, len(hosts))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        return len(hosts)
+
+    def results(self):
+        """
+        Output of the latest probe of every target. Partial traces of
+        unreachable targets are included, while targets whose latest probe
+        failed outright are left out, as they were before scheduling.
+        """
+        results = []
+        for host in self.hosts:
+            entry = self.state.get(host)
+            if entry and entry['data']:
+                results.append(entry['data'])
+
+        return results
+
+
+def dump(obj, filename, text=False):
+    import os
+    import pickle
+
+    tmp_filename = filename + '.tmp'
+    tmp = open(tmp_filename, 'w' if text else 'wb')
+    if text:
+        tmp.write(obj)
+    else:
+        pickle.dump(obj, tmp, protocol=2)
+    tmp.close()
+    os.rename(tmp_filename, filename)
 
-        out = [] 
-        t = threading.Thread(target=traceroute, args=(host, out, sema))
-        params.append((out, t))
-        t.start()
 
-    results = []
-    for out, t in params:
-        t.join()
-        if out:
-            results.append(out[0])
-
-    if results:
-        print(json.dumps(results))
+def main():
+    import json
+    import os
+    import pickle
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [target ...]')
+    parser.add_option('-s', '--state',
+                      help='Keep per-target probing state in this file and only probe targets that are due')
+    parser.add_option('-o', '--output',
+                      help='Write results to this file instead of stdout')
+    parser.add_option('-i', '--interval',
+                      type='float',
+                      default=300,
+                      help='Seconds between probes of a target whose path just changed')
+    parser.add_option('--max-interval',
+                      dest='max_interval',
+                      type='float',
+                      default=86400,
+                      help='Upper bound of the interval of stable or unreachable targets')
+    parser.add_option('-r', '--rate',
+                      type='float',
+                      default=0,
+                      help='Maximum probes started per second, 0 for no limit')
+    parser.add_option('-w', '--workers',
+                      type='int',
+                      default=10,
+                      help='Number of concurrent traceroutes')
+    parser.add_option('-l', '--loop',
+                      action='store_true',
+                      default=False,
+                      help='Keep probing targets as they become due')
+
+    (options, args) = parser.parse_args()
+
+    if options.loop and not options.output:
+        parser.error('--loop requires --output')
+
+    hosts = [host for host in (args or targets) if host]
+
+    state = {}
+    if options.state and os.path.exists(options.state):
+        try:
+            state = pickle.load(open(options.state, 'rb'))
+        except Exception as e:
+            sys.stderr.write('Ignoring unreadable state {}: {}\n'.format(options.state, e))
+
+    scheduler = Scheduler(hosts, state,
+                          interval=options.interval,
+                          max_interval=options.max_interval,
+                          rate=options.rate,
+                          workers=options.workers)
+
+    while True:
+        probed = scheduler.run_once()
+
+        if options.state:
+            dump(scheduler.state, options.state)
+
+        results = scheduler.results()
+        if options.output:
+            if probed:
+                dump(json.dumps(results), options.output, text=True)
+        elif results:
+            print(json.dumps(results))
+
+        if not options.loop:
+            break
+
+        next_due = scheduler.next_due()
+        if next_due is None:
+            break
+        time.sleep(max(next_due - time.time(), 1))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+A versioned store of route snapshots.
+
+Every route is split into its path, i.e. the endpoints and hop addresses
+together with their IP info, and the RTTs measured along it. Paths are
+stored once under their content digest and shared by all snapshots that
+observed them, while a snapshot itself is just an index of
+(source, target, digest, rtts) entries. Since most paths are stable between
+sweeps, a new snapshot costs little more than its RTTs.
+"""
+
+import logging
+import os
+import re
+
+# Default width in ms of the RTT bands compared by diff.
+RTT_BAND = 10
+
+# Snapshots are named by their UTC time with microseconds, which keeps names
+# unique and makes their string order chronological.
+NAME_RE = re.compile(r'^\d{8}T\d{6}\.\d{6}Z$')
+
+
+def snapshot_name(timestamp):
+    import time
+
+    seconds, microseconds = divmod(int(round(timestamp * 1e6)), 1000000)
+    return '{}.{:06d}Z'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime(seconds)), microseconds)
+
+
+def split_route(route):
+    source, source_info, target, target_info, hops = route
+
+    path, rtts = [], []
+    for probes in hops:
+        path.append(tuple(probe and (probe[0], probe[2]) for probe in probes))
+        rtts.append(tuple(probe and probe[1] for probe in probes))
+
+    return (source, source_info, target, target_info, tuple(path)), tuple(rtts)
+
+
+def join_route(path, rtts):
+    source, source_info, target, target_info, hops = path
+
+    routes = []
+    for probes, values in zip(hops, rtts):
+        routes.append([probe and (probe[0], rtt, probe[1]) for probe, rtt in zip(probes, values)])
+
+    return (source, source_info, target, target_info, routes)
+
+
+def hop_addresses(path):
+    return [sorted(set(probe[0] for probe in probes if probe)) for probes in path[4]]
+
+
+def path_asns(path):
+    asns = set()
+    infos = [path[1], path[3]]
+    for probes in path[4]:
+        infos.extend(probe[1] for probe in probes if probe)
+
+    for info in infos:
+        if info:
+            for network in info.get('Networks', []):
+                asns.add(network['ASN'])
+
+    return asns
+
+
+def rtt_bands(rtts, width):
+    bands = []
+    for values in rtts:
+        values = [v for v in values if v is not None]
+        bands.append(int(min(values) // width) if values else None)
+
+    return bands
+
+
+class History(object):
+    def __init__(self, path):
+        self.path = path
+        self.objects_dir = os.path.join(path, 'objects')
+        self.snapshots_dir = os.path.join(path, 'snapshots')
+        self.paths = {}
+
+    def _dump(self, obj, filename):
+        import pickle
+
+        tmp_filename = filename + '.tmp'
+        tmp = open(tmp_filename, 'wb')
+        pickle.dump(obj, tmp, protocol=2)
+        tmp.close()
+        os.rename(tmp_filename, filename)
+
+    def _load(self, filename):
+        import pickle
+
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def _object_filename(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def add(self, routes, timestamp=None):
+        """
+        Record routes as a new snapshot taken at timestamp, now by default,
+        and return its name. An empty set of routes is not recorded.
+        """
+        import hashlib
+        import pickle
+        import time
+
+        if not routes:
+            logging.warning('Not recording a snapshot without routes')
+            return None
+
+        name = snapshot_name(time.time() if timestamp is None else timestamp)
+        snapshot_filename = os.path.join(self.snapshots_dir, name)
+        if os.path.exists(snapshot_filename):
+            raise Exception('Snapshot {} already exists'.format(name))
+
+        index = []
+        written = 0
+        for route in routes:
+            path, rtts = split_route(route)
+            digest = hashlib.sha1(pickle.dumps(path, protocol=2)).hexdigest()
+            filename = self._object_filename(digest)
+            if digest not in self.paths and not os.path.exists(filename):
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                self._dump(path, filename)
+                written += 1
+            self.paths[digest] = path
+            index.append((path[0], path[2], digest, rtts))
+
+        if not os.path.isdir(self.snapshots_dir):
+            os.makedirs(self.snapshots_dir)
+        self._dump(index, snapshot_filename)
+
+        logging.info('Recorded snapshot {} with {} routes, {} new paths'.format(name, len(index), written))
+        return name
+
+    def names(self):
+        """Snapshot names, oldest first."""
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+
+        return sorted(name for name in os.listdir(self.snapshots_dir) if NAME_RE.match(name))
+
+    def index(self, name):
+        return self._load(os.path.join(self.snapshots_dir, name))
+
+    def get_path(self, digest):
+        path = self.paths.get(digest)
+        if path is None:
+            path = self.paths[digest] = self._load(self._object_filename(digest))
+
+        return path
+
+    def load(self, name):
+        """Rebuild the routes of a snapshot in the format used by route.py."""
+        return [join_route(self.get_path(digest), rtts) for _, _, digest, rtts in self.index(name)]
+
+    def diff(self, old, new, band=RTT_BAND):
+        """
+        Yield a change record per (source, target) pair that differs between
+        two snapshots. Paths are only loaded when their digests differ.
+        """
+        before = dict(((source, target), (digest, rtts)) for source, target, digest, rtts in self.index(old))
+        after = dict(((source, target), (digest, rtts)) for source, target, digest, rtts in self.index(new))
+
+        for key in sorted(set(before) | set(after)):
+            change = {'source': key[0], 'target': key[1]}
+            if key not in after:
+                change['status'] = 'removed'
+                yield change
+                continue
+            if key not in before:
+                change['status'] = 'added'
+                yield change
+                continue
+
+            (old_digest, old_rtts), (new_digest, new_rtts) = before[key], after[key]
+
+            if old_digest != new_digest:
+                old_path, new_path = self.get_path(old_digest), self.get_path(new_digest)
+
+                old_hops, new_hops = hop_addresses(old_path), hop_addresses(new_path)
+                hops = []
+                for ttl in range(max(len(old_hops), len(new_hops))):
+                    a = old_hops[ttl] if ttl < len(old_hops) else None
+                    b = new_hops[ttl] if ttl < len(new_hops) else None
+                    if a != b:
+                        hops.append({'ttl': ttl + 1, 'before': a, 'after': b})
+                if hops:
+                    change['hops'] = hops
+
+                old_asns, new_asns = path_asns(old_path), path_asns(new_path)
+                if old_asns != new_asns:
+                    change['asns'] = {
+                        'added': sorted(new_asns - old_asns),
+                        'removed': sorted(old_asns - new_asns),
+                    }
+
+            old_bands, new_bands = rtt_bands(old_rtts, band), rtt_bands(new_rtts, band)
+            rtt = []
+            for ttl in range(max(len(old_bands), len(new_bands))):
+                a = old_bands[ttl] if ttl < len(old_bands) else None
+                b = new_bands[ttl] if ttl < len(new_bands) else None
+                if a != b:
+                    rtt.append({
+                        'ttl': ttl + 1,
+                        'before': a if a is None else [a * band, (a + 1) * band],
+                        'after': b if b is None else [b * band, (b + 1) * band],
+                    })
+            if rtt:
+                change['rtt'] = rtt
+
+            if len(change) > 2:
+                change['status'] = 'changed'
+                yield change
+
+
+def main():
+    import json
+    import sys
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] list | add [FILE] | diff [OLD [NEW]]')
+    parser.add_option('-d', '--dir',
+                      default='history',
+                      help='Directory of the route history')
+    parser.add_option('--rtt-band',
+                      dest='rtt_band',
+                      type='float',
+                      default=RTT_BAND,
+                      help='Width in ms of the RTT bands compared by diff')
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(levelname)1.1s %(asctime)s %(module)s:%(lineno)d] %(message)s')
+
+    history = History(options.dir)
+    command = args[0] if args else 'list'
+
+    if command == 'list':
+        for name in history.names():
+            print(name)
+    elif command == 'add':
+        import pickle
+
+        routes = pickle.load(open(args[1] if len(args) > 1 else 'route.pickle', 'rb'))
+        history.add(routes)
+    elif command == 'diff':
+        names = history.names()
+        if len(args) > 2:
+            old, new = args[1], args[2]
+        elif len(args) > 1 and names:
+            old, new = args[1], names[-1]
+        elif len(names) >= 2:
+            old, new = names[-2], names[-1]
+        else:
+            parser.error('diff needs two snapshots')
+
+        for name in (old, new):
+            if name not in names:
+                parser.error('no such snapshot: ' + name)
+
+        for change in history.diff(old, new, options.rtt_band):
+            sys.stdout.write(json.dumps(change) + '\n')
+    else:
+        parser.error('unknown command: ' + command)
+
+
+if __name__ == '__main__':
+    main()